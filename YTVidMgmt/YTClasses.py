@@ -1,59 +1,317 @@
 # Module for interacting with app database [sqlite]
-import sys
 import logging
 import sqlite3
+import threading
+import time
 import datetime
+from contextlib import contextmanager
 from pathlib import Path
 # Custom App modules
+from YTVidMgmt import sqlprofile
+from YTVidMgmt.errors import DBError
 log = logging.getLogger(__name__)
 
+# Library schema version, stored in PRAGMA user_version
+SCHEMA_VERSION = 3
+
+# Seconds a connection waits on another host/process holding the db lock
+BUSY_TIMEOUT = 30
+
+# Library schema. Kept in sync with scripts/createTables.sql
+CREATE_TABLES_SQL = """
+PRAGMA foreign_keys = off;
+-- IMMEDIATE, workers starting together wait here, then find the tables
+BEGIN IMMEDIATE TRANSACTION;
+
+CREATE TABLE IF NOT EXISTS vidinfo (
+    vid_ID               PRIMARY KEY
+                         NOT NULL,
+    vid_title,
+    vid_url,
+    channel_url,
+    upload_date DATETIME,
+    season      INTEGER,
+    episode     INTEGER
+);
+
+-- Episode numbers are per channel and season
+CREATE UNIQUE INDEX IF NOT EXISTS vidinfo_channel_season_episode ON vidinfo (
+    channel_url,
+    season,
+    episode
+);
+
+-- Worker mode: claims on json files, path relative to the in folder
+CREATE TABLE IF NOT EXISTS file_lease (
+    json_file            PRIMARY KEY
+                         NOT NULL,
+    owner,
+    expires     REAL
+);
+
+CREATE INDEX IF NOT EXISTS file_lease_expires ON file_lease (
+    expires
+);
+
+CREATE INDEX IF NOT EXISTS file_lease_owner ON file_lease (
+    owner
+);
+
+-- Last episode handed out per channel season
+CREATE TABLE IF NOT EXISTS episode_seq (
+    channel_url          NOT NULL,
+    season      INTEGER  NOT NULL,
+    last_episode INTEGER NOT NULL,
+    PRIMARY KEY (
+        channel_url,
+        season
+    )
+);
+
+PRAGMA user_version = 3;
+COMMIT TRANSACTION;
+PRAGMA foreign_keys = on;
+"""
+
+# Upgrade scripts. key is the version the script upgrades to
+UPGRADE_SQL = {
+    2: """
+BEGIN TRANSACTION;
+CREATE UNIQUE INDEX IF NOT EXISTS vidinfo_channel_season_episode ON vidinfo (
+    channel_url,
+    season,
+    episode
+);
+PRAGMA user_version = 2;
+COMMIT TRANSACTION;
+""",
+    3: """
+BEGIN TRANSACTION;
+-- Worker mode: claims on json files, path relative to the in folder
+CREATE TABLE IF NOT EXISTS file_lease (
+    json_file            PRIMARY KEY
+                         NOT NULL,
+    owner,
+    expires     REAL
+);
+
+CREATE INDEX IF NOT EXISTS file_lease_expires ON file_lease (
+    expires
+);
+
+CREATE INDEX IF NOT EXISTS file_lease_owner ON file_lease (
+    owner
+);
+
+-- Last episode handed out per channel season
+CREATE TABLE IF NOT EXISTS episode_seq (
+    channel_url          NOT NULL,
+    season      INTEGER  NOT NULL,
+    last_episode INTEGER NOT NULL,
+    PRIMARY KEY (
+        channel_url,
+        season
+    )
+);
+
+PRAGMA user_version = 3;
+COMMIT TRANSACTION;
+""",
+}
+
 
 class APPdb:
+    """Connection pool to the app database.
+
+    Each thread reading from the database gets its own connection. All
+    writes go through a single writer connection serialized by a lock, so
+    the methods are safe to call from worker threads. A ':memory:' database
+    only exists in one connection, so there reads also use the writer.
+    """
+
     def __init__(self, name=None):
-        self.conn = None
         self.dbName = name
+        self._local = threading.local()
+        self._conns = []  # every connection opened, for close()
+        self._connsLock = threading.Lock()
+        self._writeLock = threading.RLock()
+        self._writeConn = None
         log.debug(f'name is {name}')
         if name:
             log.debug(f"attempt open db {name}")
-            try:
-                self.conn = sqlite3.connect(
-                    name, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-            except sqlite3.Error as errID:
-                log.critical(
-                    f"Database connection failure. ", exc_info=True)
-                sys.exit(1)
-            c = self.conn.cursor()
+            self._writeConn = self._connect()
+            c = self._writeConn.cursor()
             c.execute("PRAGMA database_list;")
             xtmp = c.fetchall()
             log.debug(f"database_list={xtmp}")
 
+    @property
+    def conn(self):
+        """Reader connection for the calling thread"""
+        if self._writeConn is None or self.dbName == ":memory:":
+            return self._writeConn
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _connect(self):
+        """Opens a new connection to dbName. (internal use only)
+
+        check_same_thread is off so the writer can be shared under the lock
+        and close() can close reader connections owned by other threads.
+        """
+        try:
+            conn = sqlite3.connect(
+                self.dbName, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                timeout=BUSY_TIMEOUT, check_same_thread=False)
+        except Exception as e:
+            raise DBError(f"Database connection failure. {self.dbName}") from e
+        # full sql traceback to log.debug. Set once, per connection,
+        # only when debug logging is on
+        if log.isEnabledFor(logging.DEBUG):
+            conn.set_trace_callback(log.debug)
+        with self._connsLock:
+            self._conns.append(conn)
+        log.debug(
+            f"{self.dbName}: opened connection {len(self._conns)} for thread {threading.current_thread().name}")
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        """Yields a cursor for reading. (internal use only)
+
+        Cursors return sqlite3.Row so .keys() is enabled for column names.
+        """
+        if self.dbName == ":memory:":
+            with self._writeLock:
+                c = self.conn.cursor()
+                c.row_factory = sqlite3.Row
+                yield c
+        else:
+            c = self.conn.cursor()
+            c.row_factory = sqlite3.Row
+            yield c
+
+    @contextmanager
+    def _writeTxn(self):
+        """Yields a writer cursor inside BEGIN IMMEDIATE. (internal use only)
+
+        The database write lock is held from the start, so reads made in the
+        transaction cannot be changed by other processes before the commit.
+        Rolled back if the block raises.
+        """
+        with self._writeLock:
+            c = self._writeConn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                yield c
+            except:
+                self._writeConn.rollback()
+                raise
+            self._writeConn.commit()
+
+    def close(self):
+        """Closes every connection in the pool"""
+        with self._connsLock:
+            for conn in self._conns:
+                conn.close()
+            log.debug(f"{self.dbName}: closed {len(self._conns)} connections")
+            self._conns = []
+        self._writeConn = None
+        self._local = threading.local()
+
     def chkDB(self):
         """Check database for required tables
 
         Returns:
             list: retCode, retDesc
             0, 'Database good'
-            If retCode >0 then something wrong
+            1, 'Missing table: vidinfo' - initDB required
+            2, 'Database version n' - upgradeDB required
         """
         log.debug(f"Checking database")
-        c = self.conn.cursor()
         # Check required database objects and if missing create.
         sql = "SELECT name FROM sqlite_master WHERE type='table' AND name='vidinfo'"
-        c.execute(sql)
-        if c.fetchone() is None:
+        with self._reader() as c:
+            sqlprofile.execute(c, sql)
+            row = c.fetchone()
+            sqlprofile.execute(c, "PRAGMA user_version")
+            dbVersion = c.fetchone()[0]
+        if row is None:
             log.debug('Missing table: vidinfo')
             return [1, 'Missing table: vidinfo']
+        elif dbVersion < SCHEMA_VERSION:
+            log.debug(f'Database version {dbVersion}, current is {SCHEMA_VERSION}')
+            return [2, f'Database version {dbVersion}']
         else:
             log.debug('Database good')
             return [0, 'Database good']
 
+    def upgradeDB(self):
+        """Upgrades the database schema to SCHEMA_VERSION
+
+        Version 2 makes episode numbers unique per channel and season.
+        Duplicates left by overlapping runs of version 1 are renumbered
+        first, see _renumberDupEpisodes.
+        """
+        with self._reader() as c:
+            sqlprofile.execute(c, "PRAGMA user_version")
+            dbVersion = c.fetchone()[0]
+        if dbVersion < 2:
+            self._renumberDupEpisodes()
+        for toVersion in range(max(dbVersion, 1) + 1, SCHEMA_VERSION + 1):
+            log.info(f"Upgrading database to version {toVersion}")
+            self._exeScript(script=UPGRADE_SQL[toVersion],
+                            scriptName=f"upgrade to version {toVersion}")
+
+    def _renumberDupEpisodes(self):
+        """Renumbers videos sharing an episode number in a channel season. (internal use only)
+
+        The video uploaded first keeps the number, the others get the next
+        numbers free in the season. Their files in the library keep the old
+        number in their name, a warning is logged for each so they can be
+        renamed.
+
+        Returns:
+            int: number of videos renumbered
+        """
+        dupSQL = "SELECT channel_url, season, episode FROM vidinfo WHERE episode IS NOT NULL GROUP BY channel_url, season, episode HAVING count(*) > 1"
+        vidsSQL = "SELECT vid_ID FROM vidinfo WHERE channel_url = ? AND season = ? AND episode = ? ORDER BY upload_date, rowid"
+        lastSQL = "SELECT max(episode) FROM vidinfo WHERE channel_url = ? AND season = ?"
+        updateSQL = "UPDATE vidinfo SET episode = ? WHERE vid_ID = ?"
+        renumbered = []
+        try:
+            with self._writeTxn() as c:
+                sqlprofile.execute(c, dupSQL)
+                for channel_url, season, episode in c.fetchall():
+                    sqlprofile.execute(c, vidsSQL, (channel_url, season, episode))
+                    vidIDs = [row[0] for row in c.fetchall()]
+                    for vid_ID in vidIDs[1:]:
+                        sqlprofile.execute(c, lastSQL, (channel_url, season))
+                        newEpisode = c.fetchone()[0] + 1
+                        sqlprofile.execute(c, updateSQL, (newEpisode, vid_ID))
+                        renumbered.append((channel_url, season, episode, vid_ID, newEpisode))
+        except Exception as e:
+            raise DBError('Unexpected error renumbering duplicate episodes') from e
+        for channel_url, season, episode, vid_ID, newEpisode in renumbered:
+            log.warning(
+                f"{channel_url} season {season}: vid_ID {vid_ID} shared episode {episode}, renumbered to {newEpisode}. Rename its library file to E{str(newEpisode).zfill(3)}")
+        return len(renumbered)
+
     def initDB(self, scriptPath=None):
         """Create tables, views, indexes
 
         PARM
-        scriptPath : path to script files *Required
+        scriptPath : path to script files. When None the embedded schema is used.
         """
         log.debug(f"scriptPath={scriptPath}")
+        if scriptPath is None:
+            self._exeScript(script=CREATE_TABLES_SQL,
+                            scriptName="embedded schema")
+            return
+
         scripts = ['createTables.sql']
 
         scriptDir = Path(scriptPath)
@@ -72,15 +330,22 @@ class APPdb:
         scriptFile = open(scriptFileName, 'r')
         script = scriptFile.read()
         scriptFile.close()
-        try:
-            c = self.conn.cursor()
-            c.executescript(script)
-        except:
-            log.critical(
-                f"Unexpected Error running script {scriptFileName}", exc_info=True)
-            sys.exit(1)
+        self._exeScript(script=script, scriptName=scriptFileName)
 
-        self.conn.commit()
+    def _exeScript(self, script, scriptName=None):
+        """
+        Executes sql script text. (internal use only)
+        script : SQL script to run
+        scriptName : Name used when logging
+        """
+        with self._writeLock:
+            try:
+                c = self._writeConn.cursor()
+                c.executescript(script)
+            except Exception as e:
+                raise DBError(f"Unexpected Error running script {scriptName}") from e
+
+            self._writeConn.commit()
         log.debug(f"script commited")
 
     def _exeDML(self, sql, theVals):
@@ -94,78 +359,183 @@ class APPdb:
                 ResultCode 0 = Success execution
                 Resultcode != 0 - See ResultText for details
         """
-        log.debug(f"Sql: {sql}")
-        log.debug(f"Values: {theVals}")
-        try:
-            c = self.conn.cursor()
-            # Enabling full sql traceback to log.debug
-            self.conn.set_trace_callback(log.debug)
-            c.execute(sql, theVals)
-            self.conn.commit()
-        except sqlite3.IntegrityError as e:
-            log.warning(f"sqlite integrity error: {e.args[0]}")
-            return [2, f"sqlite integrity error: {e.args[0]}"]
-        except:
-            log.critical(
-                f'Unexpected error executing sql: {sql}', exc_info=True)
-            sys.exit(1)
+        log.debug("Sql: %s", sql)
+        log.debug("Values: %s", theVals)
+        with self._writeLock:
+            try:
+                c = self._writeConn.cursor()
+                sqlprofile.execute(c, sql, theVals)
+                self._writeConn.commit()
+            except sqlite3.IntegrityError as e:
+                self._writeConn.rollback()
+                log.warning(f"sqlite integrity error: {e.args[0]}")
+                return [2, f"sqlite integrity error: {e.args[0]}"]
+            except Exception as e:
+                raise DBError(f'Unexpected error executing sql: {sql}') from e
 
         log.debug("successful commit of sql")
-        # Disable full sql traceback to log.debug
-        self.conn.set_trace_callback(None)
         return [0, "Commit successful"]
 
-    def getLastEpisode(self, season):
-        """Gets highest episode number in database
+    def getLastEpisode(self, channel_url, season):
+        """Gets highest episode number in database for the channel season
+
+        Read only. Runs number new videos through allocEpisodes, which also
+        counts numbers reserved by runs still going.
+
+        Args:
+            channel_url (str): channel the season belongs to
+            season (int): season to check
 
         Returns:
             int: highest episode number
         """
-        c = self.conn.cursor()
         selectSQL = "SELECT episode FROM vidinfo "
-        whereSQL = f"WHERE season=? ORDER BY episode DESC LIMIT 1"
-        theVals = (season,)
+        whereSQL = f"WHERE channel_url=? AND season=? ORDER BY episode DESC LIMIT 1"
+        theVals = (channel_url, season)
         log.debug(f"{self.dbName}: values = {theVals}")
         # Build SQL and execute
         sql = f"{selectSQL} {whereSQL}"
         try:
-            self.conn.row_factory = sqlite3.Row  # .keys() enabled for column names
-            # enable full sql trackback to log.debug
-            self.conn.set_trace_callback(log.debug)
-            c = self.conn.cursor()
-            c.execute(sql, theVals)
-            results = c.fetchone()
-            # Disable full sql traceback
-            self.conn.set_trace_callback(None)
-        except:
-            log.critical(
-                f'Unexpected error executing sql: {sql}', exc_info=True)
-            sys.exit(1)
+            with self._reader() as c:
+                sqlprofile.execute(c, sql, theVals)
+                results = c.fetchone()
+        except Exception as e:
+            raise DBError(f'Unexpected error executing sql: {sql}') from e
 
-        if results is None:
+        if results is None or results[0] is None:
             log.debug("No records. returning 0")
             return 0
         else:
             log.debug(f"returning {results[0]}")
             return results[0]
 
+    def allocEpisodes(self, channel_url, season, count):
+        """Atomically reserves count episode numbers for a channel season
+
+        Safe across processes and hosts sharing the database, so every
+        run numbers through here, worker or not. Numbers continue from the
+        highest of episode_seq and vidinfo. A number reserved for a video
+        that is then not added (file missing, transfer failed) is not reused.
+
+        Args:
+            channel_url (str): channel the season belongs to
+            season (int): season to number
+            count (int): episode numbers wanted
+
+        Returns:
+            int: first episode number reserved
+        """
+        sql = "SELECT max(coalesce((SELECT last_episode FROM episode_seq WHERE channel_url=:channel_url AND season=:season), 0), coalesce((SELECT max(episode) FROM vidinfo WHERE channel_url=:channel_url AND season=:season), 0))"
+        theVals = {'channel_url': channel_url, 'season': season}
+        try:
+            with self._writeTxn() as c:
+                sqlprofile.execute(c, sql, theVals)
+                lastEpisode = c.fetchone()[0]
+                theVals['last_episode'] = lastEpisode + count
+                sqlprofile.execute(
+                    c, "INSERT OR REPLACE INTO episode_seq (channel_url,season,last_episode) VALUES (:channel_url,:season,:last_episode)", theVals)
+        except Exception as e:
+            raise DBError(f'Unexpected error allocating episodes: {theVals}') from e
+        log.debug(
+            f"{channel_url} season {season}: allocated {lastEpisode + 1} to {lastEpisode + count}")
+        return lastEpisode + 1
+
+    def registerFiles(self, jsonFiles):
+        """Adds json files to file_lease, unclaimed. Files already known are left as is
+
+        Args:
+            jsonFiles (list): json file names, relative to the in folder
+
+        Returns:
+            int: number of files newly registered
+        """
+        sql = "INSERT OR IGNORE INTO file_lease (json_file) VALUES (?)"
+        try:
+            with self._writeTxn() as c:
+                sqlprofile.executemany(c, sql, [(f,) for f in jsonFiles])
+                added = c.rowcount
+        except Exception as e:
+            raise DBError(f'Unexpected error executing sql: {sql}') from e
+        log.debug(f"registered {added} of {len(jsonFiles)} json files")
+        return added
+
+    def claimFiles(self, owner, batchSize, leaseSecs):
+        """Claims up to batchSize json files not leased
+
+        Leases that expired (their worker stopped renewing them) are
+        claimed like unclaimed files.
+
+        Args:
+            owner (str): worker id claiming the files
+            batchSize (int): most files to claim
+            leaseSecs (float): seconds the claim lasts unless renewed
+
+        Returns:
+            list: json file names claimed, relative to the in folder
+        """
+        now = time.time()
+        selectSQL = "SELECT json_file FROM file_lease WHERE (expires IS NULL OR expires < ?) ORDER BY json_file LIMIT ?"
+        updateSQL = "UPDATE file_lease SET owner = ?, expires = ? WHERE json_file = ?"
+        try:
+            with self._writeTxn() as c:
+                sqlprofile.execute(c, selectSQL, (now, batchSize))
+                claimed = [row[0] for row in c.fetchall()]
+                sqlprofile.executemany(
+                    c, updateSQL, [(owner, now + leaseSecs, f) for f in claimed])
+        except Exception as e:
+            raise DBError(f'Unexpected error claiming files for {owner}') from e
+        log.debug(f"{owner} claimed {len(claimed)} json files")
+        return claimed
+
+    def renewLeases(self, owner, leaseSecs):
+        """Extends every open lease held by owner
+
+        Returns:
+            int: number of leases renewed
+        """
+        sql = "UPDATE file_lease SET expires = ? WHERE owner = ?"
+        try:
+            with self._writeTxn() as c:
+                sqlprofile.execute(c, sql, (time.time() + leaseSecs, owner))
+                renewed = c.rowcount
+        except sqlite3.OperationalError:
+            # Busy for longer than BUSY_TIMEOUT. The next beat tries again
+            log.warning(f"{owner} could not renew leases", exc_info=True)
+            return 0
+        log.debug(f"{owner} renewed {renewed} leases")
+        return renewed
+
+    def completeFiles(self, owner, jsonFiles):
+        """Removes the leases owner holds on json files it has processed
+
+        The rows are deleted, so a json file arriving later at the same
+        path is registered and claimed like any other.
+
+        Returns:
+            int: number of leases removed. Fewer than jsonFiles means a
+            lease expired and was claimed by another worker.
+        """
+        sql = "DELETE FROM file_lease WHERE json_file = ? AND owner = ?"
+        try:
+            with self._writeTxn() as c:
+                sqlprofile.executemany(c, sql, [(f, owner) for f in jsonFiles])
+                removed = c.rowcount
+        except Exception as e:
+            raise DBError(f'Unexpected error executing sql: {sql}') from e
+        if removed != len(jsonFiles):
+            log.warning(
+                f"{owner}: {len(jsonFiles) - removed} of {len(jsonFiles)} leases were lost to another worker")
+        return removed
+
     def getSeasons2Update(self):
-        c = self.conn.cursor()
-        sql = "SELECT season FROM vidinfo WHERE episode is NULL GROUP by season ORDER BY season"
+        sql = "SELECT channel_url, season FROM vidinfo WHERE episode is NULL GROUP by channel_url, season ORDER BY channel_url, season"
         # Build SQL and execute
         try:
-            self.conn.row_factory = sqlite3.Row  # .keys() enabled for column names
-            # enable full sql trackback to log.debug
-            self.conn.set_trace_callback(log.debug)
-            c = self.conn.cursor()
-            c.execute(sql)
-            results = c.fetchall()
-            # Disable full sql traceback
-            self.conn.set_trace_callback(None)
-        except:
-            log.critical(
-                f'Unexpected error executing sql: {sql}', exc_info=True)
-            sys.exit(1)
+            with self._reader() as c:
+                sqlprofile.execute(c, sql)
+                results = c.fetchall()
+        except Exception as e:
+            raise DBError(f'Unexpected error executing sql: {sql}') from e
         if results is None:
             log.debug(f"{self.dbName}: rows returned 0")
             return 0
@@ -181,21 +551,14 @@ class APPdb:
         # Build SQL and execute
         sql = f"{selectSQL} {whereSQL}"
         theVals = (value,)
-        log.debug(f"sql = {sql}")
-        log.debug(f"theVals = {theVals}")
+        log.debug("sql = %s", sql)
+        log.debug("theVals = %s", theVals)
         try:
-            self.conn.row_factory = sqlite3.Row  # .keys() enabled for column names
-            # enable full sql trackback to log.debug
-            self.conn.set_trace_callback(log.debug)
-            c = self.conn.cursor()
-            c.execute(sql, theVals)
-            row = c.fetchone()
-            # Disable full sql traceback
-            self.conn.set_trace_callback(None)
-        except:
-            log.critical(
-                f'Unexpected error executing sql: {sql}', exc_info=True)
-            sys.exit(1)
+            with self._reader() as c:
+                sqlprofile.execute(c, sql, theVals)
+                row = c.fetchone()
+        except Exception as e:
+            raise DBError(f'Unexpected error executing sql: {sql}') from e
         # row is the results, now evaluate
         if row:  # have data
             log.debug(
@@ -236,9 +599,24 @@ class APPdb:
         if r[0] == 0:
             r[1] = f"vidRec id : {vidRec.vid_ID} added"
         else:
-            log.debug(f"problem with adding vidRec {r}.")
+            log.debug("problem with adding vidRec %s.", r)
+
+        log.debug("returning %s", r)
+        return r
+
+    def delVid(self, vid_ID):
+        """Delete Video Record from db
 
-        log.debug(f"returning {r}")
+        Returns:
+            list: (resultCode, resultText)
+            resultCode = 0 success
+            resultCode > 0 unsuccessfull. See resultText
+        """
+        sql = "DELETE FROM vidinfo WHERE vid_ID=:vid_ID"
+        r = self._exeDML(sql, {'vid_ID': vid_ID})
+        if r[0] == 0:
+            r[1] = f"vidRec id : {vid_ID} deleted"
+        log.debug("returning %s", r)
         return r
 
 
@@ -0,0 +1,221 @@
+# Module for running the organizer from asyncio
+import asyncio
+import itertools
+import logging
+import concurrent.futures
+from pathlib import Path
+# Custom App modules
+from YTVidMgmt import memdb
+from YTVidMgmt import fsops
+from YTVidMgmt.organizer import Organizer
+from YTVidMgmt.progress import Progress
+from YTVidMgmt.scan import findJsonFiles
+log = logging.getLogger(__name__)
+
+# Video records read from the working db at a time, for the transfers
+CHUNK_SIZE = 100
+
+
+async def organize(inFolder, outFolder, dbLoc, copyOnly=False, concurrency=4, fs=None, executor=None):
+    """Organizes the downloads in inFolder, without blocking the event loop
+
+        results = await organize(inFolder, outFolder, dbLoc)
+
+    Args:
+        inFolder (str): Folder/Directory location where vids and json files are
+        outFolder (str): Folder/Directory location where vids and metadata should be written to
+        dbLoc (str): app database file
+        copyOnly (bool, optional): Copy video files, leave json files. Defaults to False.
+        concurrency (int, optional): File operations run at once. Defaults to 4.
+        fs (LocalFS, optional): Filesystem operations. Defaults to None (fsops.LocalFS).
+        executor (ThreadPoolExecutor, optional): Pool shared by runs for their database
+            and file work. Its max_workers caps the threads of all the runs using it,
+            it is not shut down by the run. Defaults to None (the run has its own
+            pool of concurrency threads, and a thread for the databases).
+
+    Returns:
+        list: VidResult of each video, in the order transfers completed
+    """
+    async with organizeIter(inFolder, outFolder, dbLoc, copyOnly=copyOnly,
+                            concurrency=concurrency, fs=fs, executor=executor) as run:
+        return [vidResult async for vidResult in run]
+
+
+def organizeIter(inFolder, outFolder, dbLoc, copyOnly=False, concurrency=4, fs=None, executor=None):
+    """Like organize, giving each video's result as its transfer completes
+
+        async with organizeIter(inFolder, outFolder, dbLoc) as run:
+            async for vidResult in run:
+                ...
+
+    Leaving the async with block stops the run, if it is not finished.
+    Args are as for organize.
+
+    Returns:
+        OrganizeRun: async iterable of VidResult
+    """
+    return OrganizeRun(Organizer(inFolder, outFolder, dbLoc, copyOnly=copyOnly, fs=fs),
+                       concurrency=concurrency, executor=executor)
+
+
+class OrganizeRun:
+    """One run of an Organizer on asyncio. Made by organizeIter()
+
+    Database work runs on a thread of its own, file work on a pool of
+    concurrency threads. Given an executor, both run on it instead, so
+    many runs can share one capped pool. Database calls of a run are made
+    one at a time, whichever thread they land on. Episode
+    numbers are reserved atomically in the app database, so runs sharing
+    dbLoc, in this process or others, can go at the same time.
+
+    Cancelling the task running it stops new work being started. File
+    operations and the database call already running in a thread finish
+    (they can not be interrupted), then the databases are closed before
+    CancelledError is raised. Database errors raise DBError. A failed transfer does not
+    stop the run, its VidResult has status 'failed' and its json
+    file is kept for the next run.
+
+    Args:
+        organizer (Organizer): Organizer to run
+        concurrency (int, optional): File operations run at once. Defaults to 4.
+        executor (ThreadPoolExecutor, optional): Pool shared with other runs. Defaults to None.
+    """
+
+    def __init__(self, organizer, concurrency=4, executor=None):
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be 1 or more, not {concurrency}")
+        self.organizer = organizer
+        self.concurrency = concurrency
+        self.executor = executor
+        self._gen = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._gen is None:
+            self._gen = self._run()
+        return await self._gen.__anext__()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """Stops the run, if iteration was left early, and closes the databases"""
+        if self._gen is not None:
+            await self._gen.aclose()
+
+    async def _run(self):
+        """Async generator doing the run. (internal use only)"""
+        org = self.organizer
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            dbPool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="ytvidmgmt-db")
+            ioPool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="ytvidmgmt-io")
+        else:
+            dbPool = ioPool = self.executor
+        running = {}  # file work in flight, asyncio future: concurrent future
+        dbFut = None  # database work last started, one at a time
+        appDb = inMemDbconn = vidRecs = None
+
+        def loadJson(jsonFile):
+            return jsonFile, org.loadJson(Path(jsonFile))
+
+        async def onDb(func, *args):
+            nonlocal dbFut
+            dbFut = dbPool.submit(func, *args)
+            return await asyncio.wrap_future(dbFut)
+
+        def startIO(func, *args):
+            cFut = ioPool.submit(func, *args)
+            running[asyncio.wrap_future(cFut)] = cFut
+
+        async def nextDone():
+            """Waits for file work in flight. Returns the futures finished"""
+            done, pending = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                del running[fut]
+            return done
+
+        try:
+            jsonFiles = await loop.run_in_executor(ioPool, findJsonFiles, org.inFolder, org.fs)
+            if len(jsonFiles) == 0:
+                log.info(f"No metadata files found in {org.inFolder}")
+                return
+
+            appDb = await onDb(org.openAppDb)
+            inMemDbconn = await onDb(memdb.initDB)
+
+            # json files are read concurrently, and added to the working db as
+            # they arrive. They are deleted once the run is done, so a
+            # cancelled run is picked up again by the next
+            log.info("--- Metadata json files being loaded. ---")
+            progress = Progress("Loading metadata", total=len(jsonFiles), logger=log)
+            jsonOf = {}  # vid_ID: json file
+            toLoad = list(reversed(jsonFiles))
+            while toLoad or running:
+                while toLoad and len(running) < self.concurrency:
+                    startIO(loadJson, toLoad.pop())
+                for fut in await nextDone():
+                    jsonFile, vidRec = fut.result()
+                    if vidRec.vid_ID != 0:  # 0 is json file gone, nothing to add
+                        await onDb(org.addToWorkDb, inMemDbconn, appDb, vidRec)
+                        jsonOf[vidRec.vid_ID] = jsonFile
+                    progress.update()
+            progress.done()
+
+            # Every video is transferred, so one recorded by an interrupted
+            # run, and not yet moved, is finished
+            await onDb(org.numberEpisodes, inMemDbconn, appDb)
+
+            log.info(f"--- Creating files in {org.outFolder} ---")
+            fsCache = fsops.FSCache(org.fs)
+            progress = Progress("Creating files", total=await onDb(memdb.countVidRecs, inMemDbconn), logger=log)
+            # Records stream from the working db. The generator only runs on the db thread
+            vidRecs = memdb.iterVidRecs(inMemDbconn)
+            chunk = []
+            exhausted = False
+            doneFiles = set()  # json files of videos done with
+            while True:
+                while len(running) < self.concurrency:
+                    if not chunk and not exhausted:
+                        chunk = await onDb(lambda: list(itertools.islice(vidRecs, CHUNK_SIZE)))
+                        exhausted = len(chunk) < CHUNK_SIZE
+                        chunk.reverse()
+                    if not chunk:
+                        break
+                    startIO(org.transferVid, appDb, fsCache, chunk.pop())
+                if not running:
+                    break
+                for fut in await nextDone():
+                    progress.update()
+                    vidResult = fut.result()
+                    if vidResult.status != 'failed':
+                        doneFiles.add(jsonOf[vidResult.vid_ID])
+                    yield vidResult
+            progress.done()
+            if not org.copyOnly:
+                await loop.run_in_executor(ioPool, org.delJsonFiles, [f for f in jsonFiles if f in doneFiles])
+        finally:
+            # Work not started is dropped. Work running in a thread can not
+            # be stopped, wait for it so the databases are closed after it
+            for cFut in running.values():
+                cFut.cancel()
+            if running:
+                await asyncio.wait(list(running))
+            if dbFut is not None and not dbFut.cancel() and not dbFut.done():
+                await asyncio.wait([asyncio.wrap_future(dbFut)])
+            if vidRecs is not None:
+                await onDb(vidRecs.close)
+            if inMemDbconn is not None:
+                await onDb(inMemDbconn.close)
+            if appDb is not None:
+                await onDb(appDb.close)
+            if self.executor is None:
+                ioPool.shutdown(wait=False)
+                dbPool.shutdown(wait=False)
@@ -0,0 +1,9 @@
+# Module for the exceptions raised by the app modules
+
+
+class YTVidMgmtError(Exception):
+    """Base class of the errors raised by YTVidMgmt"""
+
+
+class DBError(YTVidMgmtError):
+    """A database could not be opened, or a statement on it failed"""
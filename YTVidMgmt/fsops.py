@@ -0,0 +1,218 @@
+# Module for the filesystem operations used when organizing files
+import os
+import shutil
+import time
+import logging
+import threading
+log = logging.getLogger(__name__)
+
+
+class LocalFS:
+    """Filesystem operations used by the organizer.
+
+    Every exists, mkdir, read, write, copy, move and unlink the organizer
+    makes goes through one of these methods. Swapping in SlowFS lets a run
+    be measured as if the folders were on a network mount.
+    """
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def mkdir(self, path):
+        """Creates path and any missing parents"""
+        os.makedirs(path, exist_ok=True)
+
+    def walk(self, path):
+        return os.walk(path)
+
+    def listDir(self, path):
+        return os.listdir(path)
+
+    def readText(self, path):
+        with open(path) as rFile:
+            return rFile.read()
+
+    def writeText(self, path, text):
+        with open(path, 'w') as oFile:
+            oFile.write(text)
+
+    def copy(self, src, dst):
+        shutil.copy2(src=src, dst=dst)
+
+    def move(self, src, dst):
+        shutil.move(src=src, dst=dst)
+
+    def unlink(self, path):
+        os.unlink(path)
+
+
+class SlowFS(LocalFS):
+    """LocalFS with simulated per operation latency and bandwidth limits.
+
+    Operations are counted by name in opCounts so the number of
+    filesystem round trips per video can be measured and checked.
+
+    Args:
+        latency (float, optional): Seconds added to every operation. Defaults to 0.
+        opLatency (dict, optional): Seconds per operation name, overriding latency. Defaults to None.
+        bandwidth (int, optional): Bytes per second for data read/written. Defaults to None (unlimited).
+        moveCopies (bool, optional): Charge bandwidth on move, as when src and dst are different mounts. Defaults to False.
+    """
+
+    def __init__(self, latency=0.0, opLatency=None, bandwidth=None, moveCopies=False):
+        self.latency = latency
+        self.opLatency = opLatency or {}
+        self.bandwidth = bandwidth
+        self.moveCopies = moveCopies
+        self.opCounts = {}
+        self.bytesMoved = 0
+        self.simulatedTime = 0.0
+        self._lock = threading.Lock()
+
+    def _charge(self, opName, nBytes=0):
+        """Counts opName and sleeps for its latency and transfer time. (internal use only)"""
+        delay = self.opLatency.get(opName, self.latency)
+        if self.bandwidth and nBytes:
+            delay += nBytes / self.bandwidth
+        with self._lock:
+            self.opCounts[opName] = self.opCounts.get(opName, 0) + 1
+            self.bytesMoved += nBytes
+            self.simulatedTime += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def totalOps(self):
+        with self._lock:
+            return sum(self.opCounts.values())
+
+    def resetCounts(self):
+        with self._lock:
+            self.opCounts = {}
+            self.bytesMoved = 0
+            self.simulatedTime = 0.0
+
+    def exists(self, path):
+        self._charge('exists')
+        return super().exists(path)
+
+    def mkdir(self, path):
+        self._charge('mkdir')
+        super().mkdir(path)
+
+    def walk(self, path):
+        # One round trip per directory listed
+        for entry in super().walk(path):
+            self._charge('listdir')
+            yield entry
+
+    def listDir(self, path):
+        self._charge('listdir')
+        return super().listDir(path)
+
+    def readText(self, path):
+        text = super().readText(path)
+        self._charge('read', len(text))
+        return text
+
+    def writeText(self, path, text):
+        self._charge('write', len(text))
+        super().writeText(path, text)
+
+    def copy(self, src, dst):
+        self._charge('copy', os.path.getsize(src))
+        super().copy(src, dst)
+
+    def move(self, src, dst):
+        self._charge('move', os.path.getsize(src) if self.moveCopies else 0)
+        super().move(src, dst)
+
+    def unlink(self, path):
+        self._charge('unlink')
+        super().unlink(path)
+
+
+class FSCache:
+    """Per run cache of filesystem metadata, in front of a LocalFS.
+
+    Directories verified or created by ensureDir are remembered, so each
+    is checked once per run. exists() answers from one listing of the
+    parent directory, taken the first time a file in it is asked about.
+    A file not in the listing is confirmed with a real exists() before
+    it is reported missing, since it may have arrived after the listing.
+
+    The cache trusts that only this run changes the folders it has seen.
+    In worker mode that holds for the files a worker asks about, since
+    other workers only move the videos of the json files they claimed, so
+    a worker keeps one cache for all its batches.
+    Call invalidate() for the folders involved when a transfer fails.
+    Safe to share between the threads of one run.
+
+    Args:
+        fs (LocalFS): Filesystem operations to cache
+    """
+
+    def __init__(self, fs):
+        self.fs = fs
+        self._lock = threading.Lock()
+        self._dirs = set()  # directories known to exist
+        self._listings = {}  # directory: set of file names in it
+
+    def ensureDir(self, path):
+        """Creates directory path if it does not exist. Checked once per run
+
+        Returns:
+            bool: True if the directory was created
+        """
+        path = os.fspath(path)
+        with self._lock:
+            if path in self._dirs:
+                return False
+            created = False
+            if not self.fs.exists(path):
+                log.warning(f"Creating {path}")
+                self.fs.mkdir(path)
+                created = True
+            self._dirs.add(path)
+        return created
+
+    def exists(self, path):
+        """True if file path exists"""
+        dirName, fileName = os.path.split(os.fspath(path))
+        with self._lock:
+            listing = self._listings.get(dirName)
+            if listing is None:
+                try:
+                    listing = set(self.fs.listDir(dirName))
+                    self._dirs.add(dirName)
+                except OSError:
+                    listing = set()
+                self._listings[dirName] = listing
+            if fileName in listing:
+                return True
+        # Not listed. Could be new since the listing, ask the filesystem
+        if self.fs.exists(path):
+            self.added(path)
+            return True
+        return False
+
+    def added(self, path):
+        """Records file path as created by this run"""
+        dirName, fileName = os.path.split(os.fspath(path))
+        with self._lock:
+            if dirName in self._listings:
+                self._listings[dirName].add(fileName)
+
+    def removed(self, path):
+        """Records file path as removed (or moved away) by this run"""
+        dirName, fileName = os.path.split(os.fspath(path))
+        with self._lock:
+            if dirName in self._listings:
+                self._listings[dirName].discard(fileName)
+
+    def invalidate(self, path):
+        """Forgets everything cached about directory path"""
+        path = os.fspath(path)
+        log.debug(f"invalidating cached metadata for {path}")
+        with self._lock:
+            self._dirs.discard(path)
+            self._listings.pop(path, None)
@@ -0,0 +1,56 @@
+# Module for worker leases on json files in the shared app database
+import os
+import socket
+import logging
+import threading
+log = logging.getLogger(__name__)
+
+
+def workerID():
+    """Id for this worker process, unique across hosts sharing a database"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Heartbeat:
+    """Renews the leases held by owner in a background thread.
+
+    Leases are renewed every leaseSecs / 3 seconds while the heartbeat runs,
+    so a claim only expires when its worker has stopped. Use as a context
+    manager around the processing of a claimed batch.
+
+    Args:
+        appDb (APPdb): shared app database
+        owner (str): worker id holding the leases
+        leaseSecs (float): seconds a lease lasts unless renewed
+    """
+
+    def __init__(self, appDb, owner, leaseSecs):
+        self.appDb = appDb
+        self.owner = owner
+        self.leaseSecs = leaseSecs
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"heartbeat-{self.owner}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        interval = self.leaseSecs / 3
+        while not self._stop.wait(interval):
+            self.appDb.renewLeases(self.owner, self.leaseSecs)
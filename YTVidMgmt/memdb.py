@@ -1,16 +1,50 @@
-import sys
 import logging
 import sqlite3
 import datetime
 from pathlib import Path
+# Custom App modules
+from YTVidMgmt import sqlprofile
+from YTVidMgmt.errors import DBError
+from YTVidMgmt import YTClasses
 log = logging.getLogger(__name__)
 
-
-def initDB(scriptPath, dbLoc=":memory:"):
+# Working table schema. Kept in sync with scripts/createInMem.sql
+CREATE_INMEM_SQL = """
+PRAGMA foreign_keys = off;
+BEGIN TRANSACTION;
+
+CREATE TABLE vidinfo (
+    vid_ID               PRIMARY KEY
+                         NOT NULL,
+    vid_title,
+    vid_url,
+    channel_url,
+    upload_date DATETIME,
+    season      INTEGER,
+    episode     INTEGER,
+    dl_FileName
+);
+
+CREATE INDEX vidinfo_channel_season ON vidinfo (
+    channel_url,
+    season,
+    episode,
+    upload_date
+);
+
+COMMIT TRANSACTION;
+PRAGMA foreign_keys = on;
+"""
+
+
+def initDB(scriptPath=None, dbLoc=":memory:"):
     """Initialize temporary database in memory.
 
+    The connection may be used from any thread, one at a time, so an
+    asyncio run can move its db work between the threads of a pool.
+
     Args:
-        scriptPath (PathType): The script path for executing script to create tables in database
+        scriptPath (PathType, optional): Script path holding createInMem.sql. Defaults to None, which uses the embedded schema.
 
     Returns:
         [dbConnection]: The dbconnection to the database
@@ -18,13 +52,19 @@ def initDB(scriptPath, dbLoc=":memory:"):
     log.debug(f'create working db {dbLoc}')
     try:
         conn = sqlite3.connect(
-            dbLoc, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-    except sqlite3.Error as errID:
-        log.critical(
-            f":InMEMdb: Database connection failure. ", exc_info=True)
-        sys.exit(1)
+            dbLoc, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False)
+    except Exception as e:
+        raise DBError(f":InMEMdb: Database connection failure. ") from e
+    # full sql traceback to log.debug, only when debug logging is on
+    if log.isEnabledFor(logging.DEBUG):
+        conn.set_trace_callback(log.debug)
 
     log.debug(f"init db scriptPath={scriptPath}")
+    if scriptPath is None:
+        _exeScript(dbConn=conn, script=CREATE_INMEM_SQL, scriptName="embedded schema")
+        return conn
+
     scripts = ['createInMem.sql']
     scriptDir = Path(scriptPath)
     for sFile in scripts:
@@ -36,7 +76,7 @@ def initDB(scriptPath, dbLoc=":memory:"):
 
 
 def addVidRec(dbConn, vidRec):
-    log.debug(f"adding vidRec: {vidRec}")
+    log.debug("adding vidRec: %s", vidRec)
     sql = "INSERT INTO vidinfo (vid_ID, vid_url,channel_url,upload_date,vid_title,season,episode,dl_FileName) VALUES (:vid_ID,:vid_url,:channel_url,:upload_date,:vid_title,:season,:episode,:dl_filename)"
     theVals = {
         'vid_ID': vidRec.vid_ID,
@@ -53,30 +93,28 @@ def addVidRec(dbConn, vidRec):
     if result[0] == 0:
         result[1] = f"vidRec id : {vidRec.vid_ID} added"
     else:
-        log.debug(f"problem adding vidRec {result}.")
+        log.debug("problem adding vidRec %s.", result)
 
-    log.debug(f"returning {result}")
+    log.debug("returning %s", result)
     return result
 
 
 def getSeasons2Update(dbConn):
-    """Get the season which need to be updated.
+    """Get the channel seasons which need to be updated.
 
     Args:
         dbConn (db Connection): db connection object to the database
 
     Returns:
-        [list]: A list of vid_id's.    """
-    sql = "SELECT season FROM vidinfo WHERE episode is NULL GROUP by season ORDER BY season"
+        [list]: A list of (channel_url, season, video count) rows.    """
+    sql = "SELECT channel_url, season, count(*) FROM vidinfo WHERE episode is NULL GROUP by channel_url, season ORDER BY channel_url, season"
     # Build SQL and execute
     try:
         c = dbConn.cursor()
-        c.execute(sql)
+        sqlprofile.execute(c, sql)
         results = c.fetchall()
-    except:
-        log.critical(
-            f'Unexpected error executing sql: {sql}', exc_info=True)
-        sys.exit(1)
+    except Exception as e:
+        raise DBError(f'Unexpected error executing sql: {sql}') from e
     if results is None:
         log.debug(f"rows returned 0")
         return 0
@@ -85,119 +123,89 @@ def getSeasons2Update(dbConn):
         return results
 
 
-def getAllVidRows(dbConn):
-    """Returns a list of all vid_id's in dbConn
-
-    Args:
-        dbConn (db connection): DB connection to the inmem database
-
-    Returns:
-        [list]: A list of vid_id's.
-    """
-    sql = f"SELECT vid_ID FROM vidinfo ORDER by upload_date"
-    # execute SQL
+def countVidRecs(dbConn):
+    """Returns the number of video records in dbConn"""
+    sql = "SELECT count(*) FROM vidinfo"
     try:
         c = dbConn.cursor()
-        c.execute(sql)
-        results = c.fetchall()
-    except:
-        log.critical(
-            f'Unexpected error executing sql: {sql}', exc_info=True)
-        sys.exit(1)
-    if results is None:
-        log.debug(f"rows returned 0")
-        return 0
-    else:
-        log.debug(f"rows returned {len(results)}")
-        return results
+        sqlprofile.execute(c, sql)
+        count = c.fetchone()[0]
+    except Exception as e:
+        raise DBError(f'Unexpected error executing sql: {sql}') from e
+    log.debug(f"record count {count}")
+    return count
+
 
+def iterVidRecs(dbConn, channel_url=None, season=None, unnumbered=False, batchSize=500):
+    """Streams video records in upload_date order from a single cursor
 
-def getVidRecsSeason(dbConn, season):
-    """Get vid ID's for season which need to be updated..
+    Rows are read in fetchmany batches of batchSize, so memory stays flat
+    however many records there are. Do not change vidinfo on dbConn until
+    the generator is exhausted, sqlite leaves that undefined.
 
     Args:
-        dbConn (db Connection): db connection object to the database
+        dbConn (db connection): DB connection to the inmem database
+        channel_url (str, optional): Only records for this channel. Defaults to None (all).
+        season (int, optional): Only records for this season. Defaults to None (all).
+        unnumbered (bool, optional): Only records with no episode yet. Defaults to False.
+        batchSize (int, optional): Rows per fetchmany. Defaults to 500.
 
-    Returns:
-        [list]: A list of vid_id's.
+    Yields:
+        VidRec obj: fully populated video record, dl_file included
     """
-    sql = f"SELECT vid_ID FROM vidinfo WHERE episode is NULL AND season={season} ORDER by upload_date"
-    # Execute SQL
+    whereSQL = []
+    theVals = {}
+    if channel_url is not None:
+        whereSQL.append("channel_url = :channel_url")
+        theVals['channel_url'] = channel_url
+    if season is not None:
+        whereSQL.append("season = :season")
+        theVals['season'] = season
+    if unnumbered:
+        whereSQL.append("episode is NULL")
+    sql = "SELECT vid_ID,vid_title,vid_url,channel_url,upload_date,season,episode,dl_FileName FROM vidinfo"
+    if whereSQL:
+        sql = f"{sql} WHERE {' AND '.join(whereSQL)}"
+    sql = f"{sql} ORDER by upload_date"
     try:
         c = dbConn.cursor()
-        c.execute(sql)
-        results = c.fetchall()
-    except:
-        log.critical(
-            f'Unexpected error executing sql: {sql}', exc_info=True)
-        sys.exit(1)
-    if results is None:
-        log.debug(f"rows returned 0")
-        return 0
-    else:
-        log.debug(f"rows returned {len(results)}")
-        return results
-
+        c.row_factory = None  # plain tuples, unpacked below
+        sqlprofile.execute(c, sql, theVals)
+    except Exception as e:
+        raise DBError(f'Unexpected error executing sql: {sql}') from e
 
-def getVidRow(dbConn, vid_ID):
-    selectSQL = "SELECT vid_ID,vid_title,vid_url,channel_url,upload_date,season,episode,dl_Filename FROM vidinfo"
-    whereSQL = "WHERE vid_ID=?"
-    value = vid_ID
-    # Build SQL and execute
-    sql = f"{selectSQL} {whereSQL}"
-    theVals = (value,)
-    log.debug(f"sql = {sql}")
-    log.debug(f"theVals = {theVals}")
-    try:
-        dbConn.row_factory = sqlite3.Row
-        # enable full sql traceback
-        dbConn.set_trace_callback(log.debug)
-        c = dbConn.cursor()
-        c.execute(sql, theVals)
-        row = c.fetchone()
-        # Disable full sql traceback
-        dbConn.set_trace_callback(None)
-    except:
-        log.critical(
-            f'Unexpected error executing sql: {sql}', exc_info=True)
-        sys.exit(1)
-
-    if row is None:
-        log.error(f"record for vid_ID:{vid_ID} NOT found")
-        return 0
-    else:
-        log.debug(f"record for vid_ID:{vid_ID} found.")
-        return row
+    while True:
+        rows = c.fetchmany(batchSize)
+        if not rows:
+            break
+        for row in rows:
+            vidRec = YTClasses.VidRec(row[0])
+            (vidRec.vid_title, vidRec.vid_url, vidRec.channel_url, vidRec.upload_date,
+             vidRec.season, vidRec.episode, vidRec.dl_file) = row[1:]
+            yield vidRec
 
 
-def updateVidRec(dbConn, vidRec):
-    """Update in memory video record
+def updateEpisodes(dbConn, episodes):
+    """Update episode numbers of many in memory video records in one transaction
 
     Args:
         dbConn ([type]): dbconnection to inmemory database
-        vidRec ([type]): Video record to be updated
+        episodes (list): (episode, vid_ID) pairs to be updated
 
     Returns:
         list: [retCode,retDescription]
-        NOTE: if there is any error is updating record this method will critical fail out.
+        NOTE: if there is any error updating records this method raises DBError.
     """
-    log.debug(f"updating vidRec: {vidRec}")
-    updateSQL = "UPDATE vidinfo "
-    setSQL = "SET episode = :episode "
-    whereSQL = "WHERE vid_ID = :vid_ID"
-    sql = f"{updateSQL} {setSQL} {whereSQL}"
-    theVals = {
-        'vid_ID': vidRec.vid_ID,
-        'episode': vidRec.episode}
-    result = _exeDML(dbConn, sql, theVals)
-    if result[0] == 0:
-        result[1] = f"vidRec id : {vidRec.vid_ID} updated"
-    else:
-        log.critical(f"problem adding vidRec {result}.")
-        sys.exit(1)
+    sql = "UPDATE vidinfo SET episode = ? WHERE vid_ID = ?"
+    log.debug(f"updating {len(episodes)} episode numbers")
+    try:
+        c = dbConn.cursor()
+        sqlprofile.executemany(c, sql, episodes)
+        dbConn.commit()
+    except Exception as e:
+        raise DBError(f'Unexpected error executing sql: {sql}') from e
 
-    log.debug(f"returning {result}")
-    return result
+    return [0, f"{len(episodes)} vidRecs updated"]
 
 
 def _exeScriptFile(dbConn, scriptFileName):
@@ -209,13 +217,20 @@ def _exeScriptFile(dbConn, scriptFileName):
     scriptFile = open(scriptFileName, 'r')
     script = scriptFile.read()
     scriptFile.close()
+    _exeScript(dbConn=dbConn, script=script, scriptName=scriptFileName)
+
+
+def _exeScript(dbConn, script, scriptName):
+    """
+    Executes a sql script. (internal use only)
+    script : SQL script text to run
+    scriptName : Name used when logging
+    """
     try:
         c = dbConn.cursor()
         c.executescript(script)
-    except:
-        log.critical(
-            f":InMEMdb: Unexpected Error running script {scriptFileName}", exc_info=True)
-        sys.exit(1)
+    except Exception as e:
+        raise DBError(f":InMEMdb: Unexpected Error running script {scriptName}") from e
 
     dbConn.commit()
     log.debug(f"script commited")
@@ -232,23 +247,17 @@ def _exeDML(dbConn, sql, theVals):
             ResultCode 0 = Success execution
             Resultcode != 0 - See ResultText for details
     """
-    log.debug(f"Sql: {sql}")
-    log.debug(f"Values: {theVals}")
+    log.debug("Sql: %s", sql)
+    log.debug("Values: %s", theVals)
     try:
         c = dbConn.cursor()
-        # Enabling full sql traceback to log.debug
-        dbConn.set_trace_callback(log.debug)
-        c.execute(sql, theVals)
+        sqlprofile.execute(c, sql, theVals)
         dbConn.commit()
     except sqlite3.IntegrityError as e:
         log.warning(f"sqlite integrity error: {e.args[0]}")
         return [2, f"sqlite integrity error: {e.args[0]}"]
-    except:
-        log.critical(
-            f'Unexpected error executing sql: {sql}', exc_info=True)
-        sys.exit(1)
+    except Exception as e:
+        raise DBError(f'Unexpected error executing sql: {sql}') from e
 
     log.debug("successful commit of sql")
-    # Disable full sql traceback to log.debug
-    dbConn.set_trace_callback(None)
     return [0, "Commit successful"]
@@ -0,0 +1,511 @@
+# Module for organizing youtube-dl downloads into a plex library
+import os
+import copy
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+# Custom App modules
+from YTVidMgmt import YTClasses
+from YTVidMgmt import memdb
+from YTVidMgmt import fsops
+from YTVidMgmt import lease
+from YTVidMgmt.errors import DBError
+from YTVidMgmt.progress import Progress
+from YTVidMgmt.scan import findJsonFiles
+log = logging.getLogger(__name__)
+
+
+def cleanStr(dirtyStr):
+    """Replaces $%&*:@'\\/" in a string with an underscore
+
+    Args:
+        dirtyStr (str): The string to clean
+
+    Returns:
+        str: the string cleaned
+    """
+    badChar = ["$", "!", "%", "&", "*", ":", "@", "'", "\\", "/"]
+    log.debug("Cleaning string: %s", dirtyStr)
+    # encode so on ASCII characters
+    encoded_string = dirtyStr.encode("ascii", "ignore")
+    decode_string = encoded_string.decode()
+    log.debug("stripped to ASCII decode_string: %s", decode_string)
+
+    # Replace badChar in ascII only string
+    for b in badChar:
+        decode_string = decode_string.replace(b, "_")
+
+    log.debug("Cleaned string : %s", decode_string)
+    return decode_string
+
+
+def calcFilename(vidRec, YTChannel):
+    """Creates a base filename based on factors in the vidRec"""
+    # YouTubeChannel_SnnnnEnnn_yyyy-mm-dd_title.id.extension
+    # Get a clean title
+    cleanTitle = cleanStr(vidRec.vid_title)
+    season = vidRec.upload_date[:4]
+    episode = str(vidRec.episode).zfill(3)
+    upload_date = vidRec.upload_date
+    vidID = vidRec.vid_ID
+    log.debug(
+        "cleanTitle=%s,season=%s,episode=%s,upload_date=%s,vidID=%s,dl_file=%s",
+        cleanTitle, season, episode, upload_date, vidID, vidRec.dl_file)
+
+    return f"{YTChannel} - S{season}E{episode} - {cleanTitle}.{vidID}"
+
+
+class VidResult:
+    """Outcome of putting one video in the out folder
+
+    status is one of:
+        'created' - video and metadata file are in the out folder
+        'exists'  - already in the library, transferred by an earlier run
+        'missing' - downloaded video file not found, nothing done
+        'failed'  - transfer failed, error has the exception
+
+    Args:
+        vidRec (VidRec): the video record, with its episode number
+        status (str): created, exists, missing or failed
+        vidFile (str, optional): video file in the out folder. Defaults to None.
+        metaFile (str, optional): metadata file in the out folder. Defaults to None.
+        error (Exception, optional): why the transfer failed. Defaults to None.
+    """
+
+    def __init__(self, vidRec, status, vidFile=None, metaFile=None, error=None):
+        self.vidRec = vidRec
+        self.status = status
+        self.vidFile = vidFile
+        self.metaFile = metaFile
+        self.error = error
+
+    @property
+    def vid_ID(self):
+        return self.vidRec.vid_ID
+
+    def __str__(self):
+        return f"vid_ID: {self.vidRec.vid_ID}, season: {self.vidRec.season}, episode: {self.vidRec.episode}, status: {self.status}"
+
+
+class Organizer:
+    """Loads youtube-dl json files, numbers the videos and puts them in the out folder
+
+    All the state of a run is held here, so several organizers (one per
+    channel download folder, say) can run in one process. Errors with the
+    databases raise DBError.
+
+    Args:
+        inFolder (str): Folder/Directory location where vids and json files are
+        outFolder (str): Folder/Directory location where vids and metadata should be written to
+        dbLoc (str): app database file
+        copyOnly (bool, optional): Copy video files, leave json files. Defaults to False.
+        noInMemDb (bool, optional): Working db on disk next to dbLoc. Defaults to False.
+        fs (LocalFS, optional): Filesystem operations. Defaults to None (fsops.LocalFS).
+        worker (bool, optional): Share the work with other workers using dbLoc. Defaults to False.
+        batchSize (int, optional): Worker mode. json files claimed at a time. Defaults to 100.
+        leaseSecs (float, optional): Worker mode. Seconds a claim lasts without a heartbeat. Defaults to 300.
+    """
+
+    def __init__(self, inFolder, outFolder, dbLoc, copyOnly=False, noInMemDb=False, fs=None,
+                 worker=False, batchSize=100, leaseSecs=300):
+        self.inFolder = inFolder
+        self.outFolder = outFolder
+        self.dbLoc = dbLoc
+        self.copyOnly = copyOnly
+        self.noInMemDb = noInMemDb
+        self.fs = fs if fs is not None else fsops.LocalFS()
+        self.worker = worker
+        self.batchSize = batchSize
+        self.leaseSecs = leaseSecs
+        # Folder name is the channel name used in file names
+        self.ytChannel = os.path.basename(os.path.normpath(inFolder))
+
+    def openAppDb(self):
+        """Opens the app database, creating or upgrading it as needed
+
+        Returns:
+            APPdb: the app database
+        """
+        appDb = YTClasses.APPdb(self.dbLoc)
+        dbStatus = appDb.chkDB()
+        if dbStatus[0] == 1:
+            log.warning("Initializing database")
+            appDb.initDB()
+        elif dbStatus[0] == 2:
+            log.warning(f"Upgrading database. {dbStatus[1]}")
+            appDb.upgradeDB()
+        log.info("Connected to database")
+        return appDb
+
+    def run(self, jsonFiles=None):
+        """Processes the json files in inFolder
+
+        Args:
+            jsonFiles (list, optional): json files already found in inFolder. Defaults to None (search for them).
+        """
+        if jsonFiles is None:
+            jsonFiles = findJsonFiles(self.inFolder, self.fs)
+        if len(jsonFiles) == 0:
+            log.info(f"No metadata files found in {self.inFolder}")
+            return
+
+        appDb = self.openAppDb()
+        try:
+            if self.worker:
+                self.runWorker(jsonFiles, appDb)
+            else:
+                # Cleaning up for inMem work db. It may have been on disk
+                dbLoc = Path(self.dbLoc).parent / "inMem.tmp"
+                if dbLoc.exists():
+                    log.debug(f"Removing {dbLoc}")
+                    dbLoc.unlink()
+
+                if not self.noInMemDb:  # inMem working db will be in Memory
+                    dbLoc = ":memory:"
+                else:
+                    log.info(f"In memory db : {dbLoc}")
+
+                doneFiles = self.processFiles(jsonFiles, appDb, dbLoc)
+                if not self.copyOnly:
+                    self.delJsonFiles(doneFiles)
+        finally:
+            appDb.close()
+
+    def loadJson(self, jsonFile):
+        """Creates vidRec object from jsonFile
+
+        Args:
+            jsonFile (Path obj): json file to load
+
+        Returns:
+            VidRec obj: video record class object. vid_ID is 0 if jsonFile does not exist
+        """
+        vidRec = YTClasses.VidRec(0)
+        # Load json. A missing file is reported by the read itself
+        try:
+            jData = json.loads(self.fs.readText(jsonFile))
+        except FileNotFoundError:
+            log.warning(f"{jsonFile} does not exist")
+            return vidRec
+
+        log.debug("Loaded file: %s", jsonFile)
+        vidRec.vid_ID = jData['id']
+        vidRec.vid_url = jData['webpage_url']
+        vidRec.channel_url = jData['channel_url']
+        # Convert the YYYYMMDD to YYYY-MM-DD for vidRec
+        uploadDate = datetime.strptime(jData['upload_date'], '%Y%m%d')
+        vidRec.upload_date = uploadDate.strftime('%Y-%m-%d')
+        vidRec.season = uploadDate.strftime('%Y')
+        vidRec.vid_title = jData['title']
+        vidRec.dl_file = jData['_filename']
+
+        return vidRec
+
+    def delJsonFiles(self, jsonFiles):
+        """Deletes jsonFiles once processed. Files already gone are ignored
+
+        Args:
+            jsonFiles (list): json file names to delete
+        """
+        for jsonFile in jsonFiles:
+            try:
+                self.fs.unlink(jsonFile)
+            except FileNotFoundError:
+                pass
+
+    def createMetaFile(self, vidRec, metafName):
+        """Creates metafName based on vidRec object
+        file format criteria https://bitbucket.org/mjarends/extendedpersonalmedia-agent.bundle/src/0982485ee6d54b5b927434210bd694f29a159ef7/Samples/show.metadata
+
+        Args:
+            vidRec (VidRec object class): Video record object
+            metafName (str): Full Path and filename of meta file to create
+        """
+        log.debug("vid_ID: %s, metafName=%s", vidRec.vid_ID, metafName)
+        # Summary data not used, as it MUST throughly cleansed of bad data from youtuber.
+        self.fs.writeText(metafName, "[metadata]\n"
+                          f"title={vidRec.vid_title}\n"
+                          f"release={vidRec.upload_date}\n")
+        log.debug("vid_ID: %s, created %s", vidRec.vid_ID, metafName)
+
+    def addToWorkDb(self, inMemDbconn, appDb, vidRec):
+        """Adds vidRec to the working db. Videos already in appDb keep their record
+
+        Args:
+            inMemDbconn ([type]): dbconnection to inmemory database
+            appDb (APPdb): app database
+            vidRec (VidRec): video record loaded from json
+        """
+        # Check db to see if video record object id exists
+        log.debug("check disk db for (%s) %s", vidRec.vid_ID, vidRec.vid_title)
+        dbVidRec = appDb.getVid(vidRec.vid_ID)
+        if dbVidRec.vid_ID == vidRec.vid_ID:  # exists in db
+            log.warning(
+                f"({vidRec.vid_ID}) {vidRec.vid_title} exists in db. meta data will be ignored")
+            # Use the db record, with the download video file name
+            dbVidRec.dl_file = vidRec.dl_file
+            vidRec = copy.copy(dbVidRec)
+        else:  # does not exist in db
+            log.debug("(%s) %s does not exist in db", vidRec.vid_ID, vidRec.vid_title)
+
+        # Adding to database
+        result = memdb.addVidRec(inMemDbconn, vidRec)
+        if result[0] != 0:  # Failure adding
+            raise DBError(
+                f"Unable to save video record. vid_id: {vidRec.vid_ID}, vidFile: {vidRec.dl_file}. Return Code: {result}")
+
+    def json2memDb(self, inMemDbconn, appDb, jsonFiles):
+        """Loads jsonFiles into the working db
+
+        Args:
+            inMemDbconn ([type]): dbconnection to inmemory database
+            appDb (APPdb): app database
+            jsonFiles (list): json file names to load
+
+        Returns:
+            dict: vid_ID: json file name, of the videos loaded
+        """
+        log.info("--- Metadata json files being loaded. ---")
+        log.debug(f"movie metadata files found: {len(jsonFiles)}")
+
+        jsonOf = {}
+        progress = Progress("Loading metadata", total=len(jsonFiles), logger=log)
+        for curFnum, jsonFile in enumerate(jsonFiles, start=1):
+            log.debug("Loading file %s of %s: %s", curFnum, len(jsonFiles), jsonFile)
+            curVidRec = self.loadJson(Path(jsonFile))
+            if curVidRec.vid_ID != 0:  # 0 is json file gone, nothing to add
+                self.addToWorkDb(inMemDbconn, appDb, curVidRec)
+                jsonOf[curVidRec.vid_ID] = jsonFile
+            progress.update()
+
+        progress.done()
+        return jsonOf
+
+    def numberEpisodes(self, inMemDbconn, appDb):
+        """Assigns episode numbers to the videos in inMemDB without one
+
+        Numbers are reserved atomically in appDb, so runs sharing it (workers,
+        asyncio runs or plain runs) can overlap without reusing a number.
+
+        Args:
+            inMemDbconn ([type]): dbconnection to inmemory database
+            appDb (APPdb): app database
+
+        Returns:
+            int: number of channel seasons numbered
+        """
+        log.info("--- Determining episode numbers ---")
+        seasons2Update = memdb.getSeasons2Update(inMemDbconn)
+        log.debug(f"seasons to update: {len(seasons2Update)}")
+        if len(seasons2Update) == 0:
+            log.info("No seasons to update")
+            return 0
+
+        progress = Progress("Numbering episodes", total=sum(sRow[2] for sRow in seasons2Update), logger=log)
+        sCount = 1
+        for sRow in seasons2Update:  # Updating each channel season
+            channelUrl, season, vidCount = sRow[0], sRow[1], sRow[2]
+            # Reserve the season's numbers
+            lastSeasonEpisode = appDb.allocEpisodes(
+                channel_url=channelUrl, season=season, count=vidCount) - 1
+
+            # Number the season's videos as they stream from the inMem database.
+            # Updates are applied once the stream is finished.
+            episodes = []  # (episode, vid_ID)
+            for curVidRec in memdb.iterVidRecs(inMemDbconn, channel_url=channelUrl, season=season, unnumbered=True):
+                lastSeasonEpisode += 1
+                episodes.append((lastSeasonEpisode, curVidRec.vid_ID))
+                log.debug(
+                    "Season %s (%s of %s) Video %s vid_ID: %s assigned episode %s",
+                    season, sCount, len(seasons2Update), len(episodes), curVidRec.vid_ID, lastSeasonEpisode)
+                progress.update()
+
+            # Update inmem db records
+            log.debug(
+                f"channel {channelUrl} season {season} - videos updated {len(episodes)}")
+            memdb.updateEpisodes(inMemDbconn, episodes)
+            sCount += 1
+
+        progress.done()
+        return len(seasons2Update)
+
+    def transferVid(self, appDb, fsCache, vidRec):
+        """Records vidRec in appDb and puts its video and metadata file in the out folder
+
+        Args:
+            appDb (APPdb): app database
+            fsCache (FSCache): filesystem metadata cache for the run
+            vidRec (VidRec): numbered video record, with dl_file
+
+        Returns:
+            VidResult: what was done
+        """
+        # Create destDir if it doesnt exist
+        destDir = self.outFolder
+        fsCache.ensureDir(destDir)
+
+        # Set destination metafile and video file names
+        baseFilename = calcFilename(vidRec, self.ytChannel)
+        destMetaFileName = os.path.join(destDir, baseFilename + ".metadata")
+        destVidFileName = os.path.join(
+            destDir, baseFilename + os.path.splitext(vidRec.dl_file)[1])
+        log.debug(
+            "vid_ID: %s, destMetaFileName=%s, destVidFileName=%s", vidRec.vid_ID, destMetaFileName, destVidFileName)
+
+        srcVidFileName = vidRec.dl_file
+        if not fsCache.exists(srcVidFileName):  # do not create files
+            # A run stopped after the transfer leaves the json of a
+            # recorded video, with its file already moved
+            dbVidRec = appDb.getVid(vidRec.vid_ID)
+            if dbVidRec.vid_ID == vidRec.vid_ID and dbVidRec.episode == vidRec.episode:
+                log.debug("vid_ID: %s, already in library as episode %s", vidRec.vid_ID, vidRec.episode)
+                return VidResult(vidRec, 'exists', vidFile=destVidFileName, metaFile=destMetaFileName)
+            log.warning(
+                f"vid_ID: {vidRec.vid_ID}, {srcVidFileName} file missing - Skipped")
+            return VidResult(vidRec, 'missing')
+
+        # Record first. If the run stops before the transfer, the json is
+        # still there, the next run finds the record and transfers under
+        # the same name
+        result = appDb.addVidRec(vidRec)
+        log.debug("Result from updating appDB: %s", result)
+        if result[0] != 0:
+            # Only a record of this same video and episode can be used
+            dbVidRec = appDb.getVid(vidRec.vid_ID)
+            if dbVidRec.vid_ID != vidRec.vid_ID or dbVidRec.episode != vidRec.episode:
+                log.error(
+                    f"vid_ID: {vidRec.vid_ID}, could not be recorded as episode {vidRec.episode}, {result[1]} - Skipped")
+                return VidResult(vidRec, 'failed', error=DBError(result[1]))
+        try:
+            self.createMetaFile(vidRec, destMetaFileName)
+            if self.copyOnly:
+                self.fs.copy(src=srcVidFileName, dst=destVidFileName)
+                log.debug(
+                    "vid_ID: %s, COPIED %s -> %s", vidRec.vid_ID, srcVidFileName, destVidFileName)
+            else:
+                self.fs.move(src=srcVidFileName, dst=destVidFileName)
+                fsCache.removed(srcVidFileName)
+                log.debug(
+                    "vid_ID: %s, moved %s -> %s", vidRec.vid_ID, srcVidFileName, destVidFileName)
+        except OSError as e:
+            log.error(
+                f"vid_ID: {vidRec.vid_ID}, transfer of {srcVidFileName} failed - Skipped", exc_info=True)
+            # Nothing cached about either side can be trusted now
+            fsCache.invalidate(os.path.dirname(srcVidFileName))
+            fsCache.invalidate(destDir)
+            if result[0] == 0:  # Only undo a record this run added
+                appDb.delVid(vidRec.vid_ID)
+            return VidResult(vidRec, 'failed', error=e)
+
+        return VidResult(vidRec, 'created', vidFile=destVidFileName, metaFile=destMetaFileName)
+
+    def createFiles(self, inMemDbconn, appDb, fsCache=None):
+        """Creates vids and meta files queued from inMemDB
+
+        Args:
+            inMemDbconn ([type]): dbconnection to inmemory database
+            appDb (APPdb): app database
+            fsCache (FSCache, optional): filesystem metadata cache to use. Defaults to
+                None (one for this call).
+
+        Returns:
+            set: vid_IDs of the videos done with, created, already in the
+            library or missing their video file
+        """
+        log.info(f"--- Creating files in {self.outFolder} ---")
+        # Every video goes to the same folder, and most come from the same
+        # download folder, so directory checks and listings are cached per run
+        if fsCache is None:
+            fsCache = fsops.FSCache(self.fs)
+        vidCount = memdb.countVidRecs(inMemDbconn)
+        progress = Progress("Creating files", total=vidCount, logger=log)
+        done = set()
+        for vCount, curVidRec in enumerate(memdb.iterVidRecs(inMemDbconn), start=1):
+            log.debug("---- start %s of %s vid_ID: %s", vCount, vidCount, curVidRec.vid_ID)
+            if self.transferVid(appDb, fsCache, curVidRec).status != 'failed':
+                done.add(curVidRec.vid_ID)
+            progress.update()
+
+        progress.done()
+        return done
+
+    def processFiles(self, jsonFiles, appDb, inMemLoc, fsCache=None):
+        """Loads jsonFiles, numbers the new videos and puts the files in the out folder
+
+        Args:
+            jsonFiles (list): json file names to process
+            appDb (APPdb): app database
+            inMemLoc (str): location of the working database, normally ':memory:'
+            fsCache (FSCache, optional): filesystem metadata cache to use. Defaults to None.
+
+        Returns:
+            list: json files of the videos done with. Those of videos that
+            failed are left out, so they are kept and tried again by the next run
+        """
+        inMemDbconn = memdb.initDB(dbLoc=inMemLoc)
+        try:
+            # movie metadata file (json) -> working memDB
+            jsonOf = self.json2memDb(inMemDbconn, appDb, jsonFiles)
+            self.numberEpisodes(inMemDbconn, appDb)
+            # Every video is transferred, not only those numbered now. A run
+            # stopped after recording a video and before moving it leaves
+            # its json, and the record is used to finish the transfer
+            done = self.createFiles(inMemDbconn, appDb, fsCache)
+        finally:
+            inMemDbconn.close()
+        doneFiles = {jsonOf[vid_ID] for vid_ID in done}
+        return [f for f in jsonFiles if f in doneFiles]
+
+    def runWorker(self, jsonFiles, appDb):
+        """Processes json files in batches claimed through leases in appDb
+
+        Several workers, on one or more hosts, can share the in folder and
+        database. Each claims a batch of files, keeps the claim alive with a
+        heartbeat while processing it, and removes the claims when done.
+        Claims of a worker that stops are taken over once they expire.
+
+        json files are only deleted once their batch is processed, so a batch
+        interrupted part way through is processed again by whoever claims it.
+        json files of videos that failed are kept, and registered again by
+        the next run.
+
+        Args:
+            jsonFiles (list): json file names found in the in folder
+            appDb (APPdb): shared app database
+        """
+        owner = lease.workerID()
+        log.info(f"Worker id    : {owner}")
+        # Working db is private to this worker
+        inMemLoc = ":memory:"
+        if self.noInMemDb:
+            inMemLoc = os.path.join(os.path.dirname(self.dbLoc),
+                                    f"inMem-{owner.replace(':', '-')}.tmp")
+            log.info(f"In memory db : {inMemLoc}")
+
+        # Leases are keyed relative to the in folder, which each host may mount elsewhere
+        added = appDb.registerFiles(
+            [os.path.relpath(f, self.inFolder) for f in jsonFiles])
+        log.info(f"Registered {added} new of {len(jsonFiles)} json files")
+
+        # One cache for all the batches, so the in folder is listed once
+        # per worker, not once per batch
+        fsCache = fsops.FSCache(self.fs)
+        batchCount = 0
+        while True:
+            claimed = appDb.claimFiles(owner, self.batchSize, self.leaseSecs)
+            if not claimed:
+                break
+            batchCount += 1
+            log.info(
+                f"--- Batch {batchCount}: claimed {len(claimed)} json files ---")
+            batchFiles = [os.path.join(self.inFolder, f) for f in claimed]
+            with lease.Heartbeat(appDb, owner, self.leaseSecs):
+                if os.path.exists(inMemLoc):
+                    os.unlink(inMemLoc)
+                doneFiles = self.processFiles(batchFiles, appDb, inMemLoc, fsCache)
+                if not self.copyOnly:
+                    self.delJsonFiles(doneFiles)
+                appDb.completeFiles(owner, claimed)
+
+        log.info(f"No unclaimed json files left. {batchCount} batches processed")
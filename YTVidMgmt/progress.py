@@ -0,0 +1,68 @@
+# Module for reporting progress of long running stages
+import time
+import logging
+log = logging.getLogger(__name__)
+
+
+class Progress:
+    """Rate limited progress reporter for one stage of processing.
+
+    update() is cheap to call per item. At most one INFO line per interval
+    is logged, with the count, rate and estimated time remaining. done()
+    logs the final count for the stage.
+
+    Args:
+        stage (str): Name of the stage, starts every line logged
+        total (int, optional): Number of items expected. Defaults to None (unknown, no ETA).
+        interval (float, optional): Minimum seconds between lines logged. Defaults to 5.
+        logger (logging.Logger, optional): Logger to use. Defaults to this module's logger.
+    """
+
+    def __init__(self, stage, total=None, interval=5.0, logger=None):
+        self.stage = stage
+        self.total = total
+        self.interval = interval
+        self.log = logger or log
+        self.count = 0
+        self.startTime = time.monotonic()
+        self._nextEmit = self.startTime + interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.done()
+
+    def update(self, n=1):
+        """Adds n items done, logging progress if interval has passed"""
+        self.count += n
+        now = time.monotonic()
+        if now >= self._nextEmit:
+            self._nextEmit = now + self.interval
+            self.log.info(self._status(now), stacklevel=2)
+
+    def done(self):
+        """Logs the final count, rate and elapsed time of the stage"""
+        elapsed = time.monotonic() - self.startTime
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        self.log.info(
+            f"{self.stage}: done, {self.count} in {_fmtSeconds(elapsed)} ({rate:.1f}/s)", stacklevel=2)
+
+    def _status(self, now):
+        """Progress line for now. (internal use only)"""
+        elapsed = now - self.startTime
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        if self.total:
+            pct = self.count / self.total * 100
+            msg = f"{self.stage}: {self.count} of {self.total} ({pct:.1f}%) {rate:.1f}/s"
+            if rate > 0:
+                msg = f"{msg} ETA {_fmtSeconds((self.total - self.count) / rate)}"
+            return msg
+        return f"{self.stage}: {self.count} {rate:.1f}/s"
+
+
+def _fmtSeconds(seconds):
+    """Formats seconds as H:MM:SS"""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
@@ -0,0 +1,22 @@
+# Module for finding the youtube-dl downloads to organize
+# Only imports os, so a run with nothing to do starts and stops quickly
+import os
+
+
+def findJsonFiles(inFolder, fs=None):
+    """Finds the youtube-dl json files in inFolder and its subfolders
+
+    Args:
+        inFolder (str): Folder to search
+        fs (LocalFS, optional): Filesystem operations. Defaults to None (os.walk).
+
+    Returns:
+        list: file names (str) of json files found
+    """
+    walk = fs.walk if fs is not None else os.walk
+    jsonFiles = []
+    for dirPath, dirNames, fileNames in walk(inFolder):
+        for fName in fileNames:
+            if fName.endswith('.json'):
+                jsonFiles.append(os.path.join(dirPath, fName))
+    return jsonFiles
@@ -0,0 +1,186 @@
+# Module for profiling sql statements run against the app databases [sqlite]
+import re
+import time
+import logging
+import threading
+log = logging.getLogger(__name__)
+
+# Active profiler. None when profiling is disabled (the default)
+_profiler = None
+
+_strLiteral = re.compile(r"'(?:[^']|'')*'")
+_numLiteral = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_whiteSpace = re.compile(r"\s+")
+
+
+def enable():
+    """Turns on sql profiling for APPdb and memdb
+
+    Returns:
+        SQLProfiler: the active profiler
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = SQLProfiler()
+        log.debug("sql profiling enabled")
+    return _profiler
+
+
+def getProfiler():
+    """Returns the active SQLProfiler, or None when profiling is disabled"""
+    return _profiler
+
+
+def execute(cursor, sql, theVals=()):
+    """Executes sql on cursor, timing it when profiling is enabled
+
+    Args:
+        cursor (sqlite3 cursor): cursor to execute on
+        sql (str): sql statement
+        theVals (tuple or dict, optional): The value parms passed into the sql
+
+    Returns:
+        sqlite3 cursor: cursor, as returned by cursor.execute
+    """
+    if _profiler is None:
+        return cursor.execute(sql, theVals)
+    return _profiler.execute(cursor, sql, theVals)
+
+
+def executemany(cursor, sql, valueList):
+    """Executes sql once per item of valueList, timing the batch when profiling is enabled
+
+    Args:
+        cursor (sqlite3 cursor): cursor to execute on
+        sql (str): sql statement
+        valueList (list): value parms for each execution
+
+    Returns:
+        sqlite3 cursor: cursor, as returned by cursor.executemany
+    """
+    if _profiler is None:
+        return cursor.executemany(sql, valueList)
+    return _profiler.executemany(cursor, sql, valueList)
+
+
+def normalizeSql(sql):
+    """Normalize sql text so statements differing only by literals group together
+
+    Args:
+        sql (str): sql statement
+
+    Returns:
+        str: sql with literals replaced by ? and whitespace collapsed
+    """
+    normSql = _strLiteral.sub("?", sql)
+    normSql = _numLiteral.sub("?", normSql)
+    return _whiteSpace.sub(" ", normSql).strip()
+
+
+def _percentile(sortedTimes, pct):
+    """Nearest rank percentile of an already sorted list"""
+    idx = max(0, int(round(pct / 100 * len(sortedTimes))) - 1)
+    return sortedTimes[min(idx, len(sortedTimes) - 1)]
+
+
+class SQLProfiler:
+    """Collects per statement timings, grouped by normalized sql text.
+
+    The query plan of each statement is captured the first time it is seen,
+    on the connection that ran it, so the plans can be shown for the slowest
+    statements when reporting.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {}  # normalized sql: [seconds, ...]
+        self.plans = {}  # normalized sql: [plan detail, ...]
+
+    def execute(self, cursor, sql, theVals=()):
+        key = normalizeSql(sql)
+        if key not in self.plans:
+            self._capturePlan(cursor.connection, key, sql, theVals)
+
+        start = time.perf_counter()
+        try:
+            return cursor.execute(sql, theVals)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings.setdefault(key, []).append(elapsed)
+
+    def executemany(self, cursor, sql, valueList):
+        """Like execute. The batch is recorded as one timing, keyed 'many: sql'"""
+        valueList = list(valueList)
+        key = f"many: {normalizeSql(sql)}"
+        if key not in self.plans and valueList:
+            self._capturePlan(cursor.connection, key, sql, valueList[0])
+
+        start = time.perf_counter()
+        try:
+            return cursor.executemany(sql, valueList)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings.setdefault(key, []).append(elapsed)
+
+    def _capturePlan(self, conn, key, sql, theVals):
+        """Stores EXPLAIN QUERY PLAN output for sql. (internal use only)"""
+        plan = []
+        if sql.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+            try:
+                c = conn.cursor()
+                c.row_factory = None
+                c.execute(f"EXPLAIN QUERY PLAN {sql}", theVals)
+                plan = [row[3] for row in c.fetchall()]
+            except Exception as e:
+                plan = [f"plan unavailable: {e}"]
+        with self._lock:
+            self.plans[key] = plan
+
+    def stats(self):
+        """Aggregated timings, slowest total first
+
+        Returns:
+            list: dicts of sql, count, total, p50, p95, max (seconds)
+        """
+        with self._lock:
+            items = [(k, sorted(v)) for k, v in self.timings.items()]
+        results = []
+        for sql, times in items:
+            results.append({'sql': sql, 'count': len(times), 'total': sum(times),
+                            'p50': _percentile(times, 50), 'p95': _percentile(times, 95),
+                            'max': times[-1]})
+        results.sort(key=lambda r: r['total'], reverse=True)
+        return results
+
+    def report(self, slowest=5, sqlWidth=70):
+        """Summary table of the statements run, and the plans of the slowest
+
+        Args:
+            slowest (int, optional): Number of statements (by max time) to show plans for. Defaults to 5.
+            sqlWidth (int, optional): Width sql text is cut to in the table. Defaults to 70.
+
+        Returns:
+            list: lines (str) of the report
+        """
+        stats = self.stats()
+        lines = [f"{'count':>7} {'total ms':>10} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}  sql"]
+        for r in stats:
+            sql = r['sql'] if len(
+                r['sql']) <= sqlWidth else r['sql'][:sqlWidth - 3] + "..."
+            lines.append(
+                f"{r['count']:>7} {r['total'] * 1000:>10.2f} {r['p50'] * 1000:>8.3f} {r['p95'] * 1000:>8.3f} {r['max'] * 1000:>8.3f}  {sql}")
+
+        lines.append(f"--- Query plans, {slowest} slowest statements ---")
+        for r in sorted(stats, key=lambda r: r['max'], reverse=True)[:slowest]:
+            lines.append(f"{r['max'] * 1000:.3f} ms: {r['sql']}")
+            for detail in self.plans.get(r['sql']) or ["(no plan)"]:
+                lines.append(f"    {detail}")
+        return lines
+
+    def logReport(self, slowest=5):
+        """Logs report() at INFO"""
+        log.info("--- SQL profile ---")
+        for line in self.report(slowest=slowest):
+            log.info(line)
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import shutil
+import sqlite3
+import subprocess
+
+import main as organizer
+from YTVidMgmt import fsops
+
+
+def makeDownloads(inFolder, vidCount, channels, vidSize):
+    """Creates youtube-dl style info.json and video files in inFolder
+
+    Args:
+        inFolder (str): Folder to create the files in
+        vidCount (int): Number of videos to create
+        channels (int): Number of channels the videos are spread across
+        vidSize (int): Size in bytes of each video file
+    """
+    os.makedirs(inFolder, exist_ok=True)
+    vidData = b"\0" * vidSize
+    for i in range(vidCount):
+        channel = f"UCbench{i % channels:04d}"
+        vidID = f"v{i:07d}"
+        vidFile = os.path.join(inFolder, f"{vidID}.mp4")
+        with open(vidFile, 'wb') as oFile:
+            oFile.write(vidData)
+        jData = {'id': vidID,
+                 'webpage_url': f"https://www.youtube.com/watch?v={vidID}",
+                 'channel_url': f"https://www.youtube.com/channel/{channel}",
+                 'upload_date': f"{2015 + i % 5}{1 + i % 12:02d}{1 + i % 28:02d}",
+                 'title': f"Benchmark video {i}",
+                 '_filename': vidFile}
+        with open(os.path.join(inFolder, f"{vidID}.info.json"), 'w') as oFile:
+            json.dump(jData, oFile)
+
+
+def parseOpLatency(values):
+    """Converts ['exists=5', ...] (milliseconds) to {'exists': 0.005, ...}"""
+    opLatency = {}
+    for value in values or []:
+        opName, ms = value.split("=", 1)
+        opLatency[opName] = float(ms) / 1000
+    return opLatency
+
+
+def runOrganizer(args, workDir, worker=False):
+    """Runs the organizer on workDir with a SlowFS built from args
+
+    Returns:
+        SlowFS: the filesystem used, with its operation counts
+    """
+    slowFS = fsops.SlowFS(latency=args.latency / 1000,
+                          opLatency=parseOpLatency(args.opLatency),
+                          bandwidth=args.bandwidth * 1048576 if args.bandwidth else None,
+                          moveCopies=args.moveCopies)
+    runArgs = argparse.Namespace(dbLoc=os.path.join(workDir, "library.db"), inFolder=os.path.join(workDir, "in"),
+                                 outFolder=os.path.join(workDir, "out"), logFile=None,
+                                 copyOnly=False, noInMemDb=False, profileSql=False,
+                                 debug=False, worker=worker, batchSize=args.batchSize, leaseSecs=300)
+    organizer.fs = slowFS
+    organizer.console.setLevel(logging.WARNING)
+    organizer.main(runArgs)
+    return slowFS
+
+
+def bench(args):
+    workDir = tempfile.mkdtemp(prefix="ytvidmgmt-bench-", dir=args.workDir)
+    try:
+        makeDownloads(os.path.join(workDir, "in"),
+                      args.vidCount, args.channels, args.vidSize)
+
+        start = time.perf_counter()
+        slowFS = runOrganizer(args, workDir)
+        wallTime = time.perf_counter() - start
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    totalOps = slowFS.totalOps()
+    opsPerVid = totalOps / args.vidCount
+    print(f"videos        : {args.vidCount} ({args.channels} channels)")
+    print(f"wall time     : {wallTime:.3f} s ({wallTime / args.vidCount * 1000:.2f} ms/video)")
+    print(f"simulated fs  : {slowFS.simulatedTime:.3f} s, {slowFS.bytesMoved} bytes")
+    print(f"fs operations : {totalOps} ({opsPerVid:.2f}/video)")
+    for opName, count in sorted(slowFS.opCounts.items()):
+        print(f"  {opName:<12}: {count:>8} ({count / args.vidCount:.2f}/video)")
+    if args.keep:
+        print(f"work folder   : {workDir}")
+
+    if args.maxOpsPerVid is not None and opsPerVid > args.maxOpsPerVid:
+        print(
+            f"FAIL: {opsPerVid:.2f} fs operations per video, limit is {args.maxOpsPerVid}")
+        return 1
+    return 0
+
+
+def checkLibrary(dbLoc, vidCount, outFolder):
+    """Checks every video was processed once and numbered without gaps
+
+    Returns:
+        list: problems found (str). Empty when all good
+    """
+    problems = []
+    conn = sqlite3.connect(dbLoc)
+    rows = conn.execute(
+        "SELECT channel_url, season, episode FROM vidinfo ORDER BY channel_url, season, episode").fetchall()
+    conn.close()
+    if len(rows) != vidCount:
+        problems.append(f"{len(rows)} videos in database, expected {vidCount}")
+    seasons = {}
+    for channelUrl, season, episode in rows:
+        seasons.setdefault((channelUrl, season), []).append(episode)
+    for key, episodes in seasons.items():
+        if episodes != list(range(1, len(episodes) + 1)):
+            problems.append(f"{key} episodes not 1..{len(episodes)}")
+    outCount = len(os.listdir(outFolder))
+    if outCount != vidCount * 2:
+        problems.append(f"{outCount} files in out folder, expected {vidCount * 2}")
+    return problems
+
+
+def benchWorkers(args):
+    """Runs args.workers worker processes against one set of downloads
+
+    Each worker is this script re-run with --workerFor, so the SlowFS
+    options apply to every worker.
+    """
+    workDir = tempfile.mkdtemp(prefix="ytvidmgmt-bench-", dir=args.workDir)
+    try:
+        outFolder = os.path.join(workDir, "out")
+        dbLoc = os.path.join(workDir, "library.db")
+        makeDownloads(os.path.join(workDir, "in"),
+                      args.vidCount, args.channels, args.vidSize)
+
+        cmd = [arg for arg in sys.argv if arg != "--keep"]
+        cmd = [sys.executable] + cmd + ["--workerFor", workDir]
+        start = time.perf_counter()
+        workers = [subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                   for w in range(args.workers)]
+        returnCodes = [worker.wait() for worker in workers]
+        wallTime = time.perf_counter() - start
+
+        problems = checkLibrary(dbLoc, args.vidCount, outFolder)
+        problems += [f"worker {w} exit code {rc}" for w,
+                     rc in enumerate(returnCodes) if rc != 0]
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    print(f"videos        : {args.vidCount} ({args.channels} channels)")
+    print(f"workers       : {args.workers}, batches of {args.batchSize}")
+    print(f"wall time     : {wallTime:.3f} s ({wallTime / args.vidCount * 1000:.2f} ms/video)")
+    if args.keep:
+        print(f"work folder   : {workDir}")
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the organizer against a simulated slow (NAS) filesystem",
+        epilog="Operation names: exists, mkdir, listdir, read, write, copy, move, unlink")
+    parser.add_argument("-n", "--vids", help="Number of videos to generate. Default 200",
+                        type=int, default=200, dest="vidCount", metavar="count")
+    parser.add_argument("--channels", help="Number of channels videos are spread across. Default 1",
+                        type=int, default=1, dest="channels", metavar="count")
+    parser.add_argument("--vidSize", help="Size in bytes of each video file. Default 1024",
+                        type=int, default=1024, dest="vidSize", metavar="bytes")
+    parser.add_argument("--latency", help="Milliseconds added to every fs operation. Default 0",
+                        type=float, default=0.0, dest="latency", metavar="ms")
+    parser.add_argument("--opLatency", help="Milliseconds for one operation, overriding --latency. Repeatable",
+                        action='append', dest="opLatency", metavar="op=ms")
+    parser.add_argument("--bandwidth", help="MiB/s for data read, written or copied. Default unlimited",
+                        type=float, dest="bandwidth", metavar="MiBps")
+    parser.add_argument("--moveCopies", help="Charge bandwidth on move (src and dst on different mounts)",
+                        action='store_true', dest="moveCopies")
+    parser.add_argument("--maxOpsPerVid", help="Exit 1 when fs operations per video exceed this",
+                        type=float, dest="maxOpsPerVid", metavar="count")
+    parser.add_argument("--workDir", help="Folder to create the temporary work folder in",
+                        type=str, dest="workDir", metavar="folderName")
+    parser.add_argument("--keep", help="Keep the work folder", action='store_true', dest="keep")
+    parser.add_argument("--workers", help="Run this many worker processes and check no video is processed twice",
+                        type=int, dest="workers", metavar="count")
+    parser.add_argument("--batchSize", help="Worker mode. json files claimed at a time. Default 20",
+                        type=int, default=20, dest="batchSize", metavar="count")
+    parser.add_argument("--workerFor", help=argparse.SUPPRESS, dest="workerFor")
+    args = parser.parse_args()
+    if args.workerFor:  # one of the processes started by --workers
+        runOrganizer(args, args.workerFor, worker=True)
+        sys.exit(0)
+    if args.workers:
+        sys.exit(benchWorkers(args))
+    sys.exit(bench(args))
@@ -16,5 +16,12 @@ CREATE TABLE vidinfo (
     dl_FileName
 );
 
+CREATE INDEX vidinfo_channel_season ON vidinfo (
+    channel_url,
+    season,
+    episode,
+    upload_date
+);
+
 COMMIT TRANSACTION;
 PRAGMA foreign_keys = on;
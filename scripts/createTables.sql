@@ -1,10 +1,11 @@
 -- Text encoding used: System
 --
 PRAGMA foreign_keys = off;
-BEGIN TRANSACTION;
+-- IMMEDIATE, workers starting together wait here, then find the tables
+BEGIN IMMEDIATE TRANSACTION;
 
 -- Table: main
-CREATE TABLE vidinfo (
+CREATE TABLE IF NOT EXISTS vidinfo (
     vid_ID               PRIMARY KEY
                          NOT NULL,
     vid_title,
@@ -15,5 +16,40 @@ CREATE TABLE vidinfo (
     episode     INTEGER
 );
 
+-- Episode numbers are per channel and season
+CREATE UNIQUE INDEX IF NOT EXISTS vidinfo_channel_season_episode ON vidinfo (
+    channel_url,
+    season,
+    episode
+);
+
+-- Worker mode: claims on json files, path relative to the in folder
+CREATE TABLE IF NOT EXISTS file_lease (
+    json_file            PRIMARY KEY
+                         NOT NULL,
+    owner,
+    expires     REAL
+);
+
+CREATE INDEX IF NOT EXISTS file_lease_expires ON file_lease (
+    expires
+);
+
+CREATE INDEX IF NOT EXISTS file_lease_owner ON file_lease (
+    owner
+);
+
+-- Last episode handed out per channel season
+CREATE TABLE IF NOT EXISTS episode_seq (
+    channel_url          NOT NULL,
+    season      INTEGER  NOT NULL,
+    last_episode INTEGER NOT NULL,
+    PRIMARY KEY (
+        channel_url,
+        season
+    )
+);
+
+PRAGMA user_version = 3;
 COMMIT TRANSACTION;
 PRAGMA foreign_keys = on;